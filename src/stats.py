@@ -1,15 +1,62 @@
-from collections import Counter, defaultdict
+import os
+import pickle
+import re
+from collections import Counter, namedtuple
+from functools import cached_property, lru_cache, partial
+from multiprocessing import Pool
 from pathlib import Path
 from typing import Union
 
 import arabic_reshaper
+import ijson
 from bidi.algorithm import get_display
-from hazm import Normalizer, sent_tokenize, word_tokenize
+from hazm import Normalizer, word_tokenize
 from loguru import logger
 from src.data import DATA_DIR  # Because of export ${PWD}, src is known
-from src.utils.io import read_file, read_json
+from src.utils.io import read_file
 from wordcloud import WordCloud
 
+# characters/words marking a question, matched in one scan
+_QUESTION_RE = re.compile(r'[?؟]|چرا|آیا')
+
+# text entity types that carry no words for the word cloud
+_SKIP_SUBTYPES = frozenset({'link', 'hashtag', 'mention', 'phone', 'email', 'code'})
+
+# one reshaper instance so its config and tables are built once, not per call;
+# ligatures are irrelevant for word-cloud rendering
+_RESHAPER = arabic_reshaper.ArabicReshaper(
+    configuration={'delete_harakat': True, 'support_ligatures': False},
+)
+
+# Arabic to Persian single-character swaps, applied with one C-level
+# translate pass so hazm's Normalizer only handles the remaining transforms
+_TRANS = str.maketrans({
+    'ي': 'ی',
+    'ك': 'ک',
+    'ة': 'ه',
+    'أ': 'ا',
+    'إ': 'ا',
+    'ٱ': 'ا',
+})
+
+# everything the stats methods need, accumulated in one walk over the chat
+_ChatScan = namedtuple(
+    '_ChatScan',
+    ['raw_texts', 'id_and_name', 'question_ids', 'answering_counts', 'talkative_counts'],
+)
+
+
+# group chats repeat many short messages verbatim, so cache their tokens;
+# each Pool worker holds its own cache, dropped when the pool exits
+@lru_cache(maxsize=131072)
+def _tokenize_chunk(text: str, stop_words: frozenset = frozenset()) -> str:
+    """tokenize one raw text chunk (module-level so Pool workers can pickle it)
+    :param text: raw text of a message or sub-message
+    :param stop_words: normalized stop words to drop, bound once per pool
+    :return: the chunk rejoined from its remaining tokens
+    """
+    return ' '.join(t for t in word_tokenize(text) if t not in stop_words)
+
 
 class ChatStatistics:
     """ Generates chat statistics from a telegram caht json file
@@ -18,16 +65,92 @@ class ChatStatistics:
         """
         :param chat_json: path to telegram export json file
         """
-        # load chat data
-        logger.info(f"Loading chat data from {chat_json}")
-        self.chat_data = read_json(chat_json)
+        # messages are streamed from the export file instead of loaded whole
+        logger.info(f"Reading chat data from {chat_json}")
+        self.chat_json = chat_json
 
         self.normalizer = Normalizer()
         # load stopwords
         logger.info(f"Loading stop words from {DATA_DIR / 'stop_words.txt'}")
-        stop_words = read_file(DATA_DIR / 'stop_words.txt').split('\n')
-        stop_words = map(str.strip, stop_words)
-        self.stop_words = set(map(self.normalizer.normalize, stop_words))
+        self.stop_words = self._load_stop_words()
+
+    def _load_stop_words(self) -> set:
+        """load the normalized stop-word set, cached on disk after the first run
+
+        Normalizing the stop words is pure and deterministic, so the result
+        is pickled next to stop_words.txt and reused while it stays newer
+        than the source file.
+        """
+        src_path = DATA_DIR / 'stop_words.txt'
+        cache_path = DATA_DIR / 'stop_words.norm.pkl'
+        try:
+            if cache_path.stat().st_mtime >= src_path.stat().st_mtime:
+                with open(cache_path, 'rb') as f:
+                    return pickle.load(f)
+        except (OSError, pickle.PickleError, EOFError):
+            pass  # no cache yet, or a corrupt one: rebuild below
+
+        stop_words = {
+            self.normalizer.normalize(word.strip())
+            for word in read_file(src_path).splitlines()
+            if word.strip()
+        }
+        try:
+            with open(cache_path, 'wb') as f:
+                pickle.dump(stop_words, f)
+        except OSError:
+            logger.warning(f"Could not cache stop words to {cache_path}")
+        return stop_words
+
+    def _iter_messages(self):
+        """stream the messages from the export file one at a time
+        """
+        with open(self.chat_json, 'rb') as f:
+            yield from ijson.items(f, 'messages.item')
+
+    @cached_property
+    def _scan(self) -> _ChatScan:
+        """accumulate everything the stats methods need over the messages
+
+        Reply counting needs the complete question flags and user names,
+        so the messages are streamed twice: the first pass gathers the
+        word-cloud text, the id-to-name map and the question flags, the
+        second pass only scans replies and senders.
+        """
+        raw_texts = []
+        id_and_name = {}
+        question_ids = set()
+
+        for msg in self._iter_messages():
+            if (from_id := msg.get('from_id')):
+                id_and_name[from_id] = msg['from']
+
+            chunks = list(self._iter_text_chunks(msg))
+            raw_texts.extend(chunks)
+
+            # reuse the flattened chunks instead of rebuilding list-typed
+            # text a second time for the question check
+            flat_text = msg['text'] if isinstance(msg['text'], str) else ' '.join(chunks)
+            if _QUESTION_RE.search(flat_text):
+                question_ids.add(msg['id'])
+
+        answering_counts = Counter()
+        talkative_counts = Counter()
+        for msg in self._iter_messages():
+            if (from_id := msg.get('from_id')) and id_and_name.get(from_id) is not None:
+                talkative_counts[from_id] += 1
+
+            if not msg.get('reply_to_message_id'):
+                continue
+            if msg['reply_to_message_id'] not in question_ids:
+                continue
+            if id_and_name[msg['from_id']] is None:
+                continue
+            answering_counts[msg['from_id']] += 1
+
+        return _ChatScan(
+            raw_texts, id_and_name, question_ids, answering_counts, talkative_counts,
+        )
 
     def generate_word_cloud(
         self,
@@ -41,29 +164,21 @@ class ChatStatistics:
         :param output_dir: path to output directory for word cloud image
         """
         logger.info("Loading text content...")
-        text_content = ''
-        for msg in self.chat_data['messages']:
-            if type(msg['text']) is str:
-                tokens = word_tokenize(msg['text'])
-                tokens = filter(lambda item: item not in self.stop_words, tokens)
-                text_content += f"\n {' '.join(tokens)}"
-
-            elif type(msg['text']) is list:
-                for sub_1 in msg['text']:
-                    if type(sub_1) is str:
-                        tokens = word_tokenize(sub_1)
-                        tokens = filter(lambda item: item not in self.stop_words, tokens)
-                        text_content += f"\n {' '.join(tokens)}"
-                    elif sub_1['type'] in ['link', 'hashtag', 'mention', 'phone', 'email']:
-                        continue
-                    else:
-                        tokens = word_tokenize(sub_1['text'])
-                        tokens = filter(lambda item: item not in self.stop_words, tokens)
-                        text_content += f"\n {' '.join(tokens)}"
+        raw_texts = self._scan.raw_texts
+
+        # tokenization is pure-Python and CPU-bound, so spread it over cores;
+        # stop words must go before reshaping, while tokens are still in
+        # base form, so the workers filter them during tokenization
+        logger.info("Tokenizing text content...")
+        tokenize = partial(_tokenize_chunk, stop_words=frozenset(self.stop_words))
+        with Pool(os.cpu_count()) as pool:
+            parts = pool.map(tokenize, raw_texts, chunksize=256)
+
+        text_content = '\n '.join(parts)
 
         # normalize reshape for final word cloud
-        text_content = self.normalizer.normalize(text_content)
-        text = arabic_reshaper.reshape(text_content)
+        text_content = self.normalizer.normalize(text_content.translate(_TRANS))
+        text = _RESHAPER.reshape(text_content)
         text = get_display(text)
 
         # generate word cloud
@@ -79,6 +194,23 @@ class ChatStatistics:
         logger.info(f"Saving word cloud to {output_dir}...")
         wordcloud.to_file(str(output_dir / 'wordcloud.png'))
 
+    @staticmethod
+    def _iter_text_chunks(msg: dict):
+        """yield the raw text pieces of a message, skipping non-word entities
+        :param msg: any message
+        """
+        text = msg['text']
+        if isinstance(text, str):
+            yield text
+            return
+        for sub_1 in text:
+            if isinstance(sub_1, str):
+                yield sub_1
+            elif sub_1['type'] in _SKIP_SUBTYPES:
+                continue
+            else:
+                yield sub_1['text']
+
     @staticmethod
     def rebuild_msg(sub_message: dict):
         """ convert a message with text type of list to convert a message with text type of string
@@ -101,21 +233,14 @@ class ChatStatistics:
         if not isinstance(msg['text'], str):
             msg['text'] = self.rebuild_msg(msg)
 
-        sentences = sent_tokenize(msg['text'])
-        for sentence in sentences:
-            if ('?' not in sentence) and ('؟' not in sentence) and ('چرا' not in sentence) and ('آیا' not in sentence):
-                continue
+        if _QUESTION_RE.search(msg['text']):
             return True
 
+    @cached_property
     def id_and_name(self):
         """map user name to user id
         """
-        id_and_name = {}
-        for msg in self.chat_data['messages']:
-            if not msg.get('from_id'):
-                continue
-            id_and_name[msg['from_id']] = msg['from']
-        return id_and_name
+        return self._scan.id_and_name
 
     def get_top_answering_users(self, top_n: int) -> dict:
         """ get Active users(not None users) with most messages response
@@ -123,36 +248,11 @@ class ChatStatistics:
         :return: a dictionary with if and number of messages response
         """
         logger.info("Getting top answering users...")
-        is_question = defaultdict(bool)
-
-        for msg in self.chat_data['messages']:
-            if not isinstance(msg['text'], str):
-                msg['text'] = self.rebuild_msg(msg)
-
-            sentences = sent_tokenize(msg['text'])
-            for sentence in sentences:
-                if ('?' not in sentence) and ('؟' not in sentence) and ('چرا' not in sentence) and ('آیا' not in sentence):
-                    continue
-                is_question[msg['id']] = True
-                break
-
-        # loads top users
-        users = []
-        user_names = self.id_and_name()
-        for msg in self.chat_data['messages']:
-            if not msg.get('reply_to_message_id'):
-                continue
-
-            if not is_question[msg['reply_to_message_id']]:
-                continue
-            if user_names[msg['from_id']] is None:
-                continue
-
-            users.append(msg['from_id'])
-        top_users = dict(Counter(users).most_common(top_n))
+        user_names = self.id_and_name
+        top_users = dict(self._scan.answering_counts.most_common(top_n))
 
         f_top_users = {user_names[k]: v for k,v in top_users.items()}
-        print('Top answering users', f_top_users, end='\n\n')
+        logger.info("Top answering users: {}", f_top_users)
         return f_top_users
 
     def get_most_talkative_users(self, top_n: int) -> dict:
@@ -161,19 +261,11 @@ class ChatStatistics:
         :return: a dictionary with if and number of messages response
         """
         logger.info("Getting most talkative users...")
-
-        # loads top users
-        users = []
-        user_names = self.id_and_name()
-        for msg in self.chat_data['messages']:
-            if user_names.get(msg.get('from_id')) is None:
-                continue
-
-            users.append(msg['from_id'])
-        top_users = dict(Counter(users).most_common(top_n))
+        user_names = self.id_and_name
+        top_users = dict(self._scan.talkative_counts.most_common(top_n))
 
         f_top_users = {user_names[k]: v for k,v in top_users.items()}
-        print('Most talkative users', f_top_users, end='\n\n')
+        logger.info("Most talkative users: {}", f_top_users)
         return f_top_users
 
 